@@ -1,18 +1,21 @@
+from functools import partial
+import zlib
+
 import netket as nk
-import networkx as nx
 import numpy as np
 import pytest
-from pytest import approx
-import os
 
 from rbm import PyRbm
 
+
 def merge_dicts(x, y):
     z = x.copy()  # start with x's keys and values
     z.update(y)  # modifies z with y's keys and values & returns None
     return z
 
 
+# The machines are stored as factories, so that they are only constructed
+# when a test actually uses them (see the ``machine`` fixture below)
 machines = {}
 
 # TESTS FOR SPIN HILBERT
@@ -22,23 +25,26 @@ g = nk.graph.Hypercube(length=4, n_dim=1)
 # Hilbert space of spins from given graph
 hi = nk.hilbert.Spin(s=0.5, graph=g)
 
-machines["RbmSpin 1d Hypercube spin"] = nk.machine.RbmSpin(hilbert=hi, alpha=2)
+machines["RbmSpin 1d Hypercube spin"] = partial(nk.machine.RbmSpin, hilbert=hi, alpha=2)
 
-machines["PyRbm 1d Hypercube spin"] = PyRbm(hilbert=hi, alpha=3)
+machines["PyRbm 1d Hypercube spin"] = partial(PyRbm, hilbert=hi, alpha=3)
 
-machines["RbmSpinSymm 1d Hypercube spin"] = nk.machine.RbmSpinSymm(hilbert=hi, alpha=2)
+machines["RbmSpinSymm 1d Hypercube spin"] = partial(
+    nk.machine.RbmSpinSymm, hilbert=hi, alpha=2
+)
 
-machines["Real RBM"] = nk.machine.RbmSpinReal(hilbert=hi, alpha=1)
+machines["Real RBM"] = partial(nk.machine.RbmSpinReal, hilbert=hi, alpha=1)
 
-machines["Phase RBM"] = nk.machine.RbmSpinPhase(hilbert=hi, alpha=2)
+machines["Phase RBM"] = partial(nk.machine.RbmSpinPhase, hilbert=hi, alpha=2)
 
-machines["Jastrow 1d Hypercube spin"] = nk.machine.Jastrow(hilbert=hi)
+machines["Jastrow 1d Hypercube spin"] = partial(nk.machine.Jastrow, hilbert=hi)
 
 hi = nk.hilbert.Spin(s=0.5, graph=g, total_sz=0)
-machines["Jastrow 1d Hypercube spin"] = nk.machine.JastrowSymm(hilbert=hi)
+machines["Jastrow 1d Hypercube spin"] = partial(nk.machine.JastrowSymm, hilbert=hi)
 
 dm_machines = {}
-dm_machines["Phase NDM"] = nk.machine.NdmSpinPhase(
+dm_machines["Phase NDM"] = partial(
+    nk.machine.NdmSpinPhase,
     hilbert=hi,
     alpha=2,
     beta=2,
@@ -47,215 +53,292 @@ dm_machines["Phase NDM"] = nk.machine.NdmSpinPhase(
     use_ancilla_bias=True,
 )
 
-# Layers
-layers = (
-    nk.layer.FullyConnected(input_size=g.n_sites, output_size=40),
-    nk.layer.Lncosh(input_size=40),
-)
+
+def ffnn_fully_connected(hi):
+    # Layers
+    layers = (
+        nk.layer.FullyConnected(input_size=hi.size, output_size=40),
+        nk.layer.Lncosh(input_size=40),
+    )
+    return nk.machine.FFNN(hi, layers)
+
+
+def ffnn_convolutional(hi):
+    # Layers
+    layers = (
+        nk.layer.ConvolutionalHypercube(
+            length=4,
+            n_dim=1,
+            input_channels=1,
+            output_channels=2,
+            stride=1,
+            kernel_length=2,
+            use_bias=True,
+        ),
+        nk.layer.Lncosh(input_size=8),
+    )
+    return nk.machine.FFNN(hi, layers)
+
 
 # FFNN Machine
-machines["FFFN 1d Hypercube spin FullyConnected"] = nk.machine.FFNN(hi, layers)
-
-layers = (
-    nk.layer.ConvolutionalHypercube(
-        length=4,
-        n_dim=1,
-        input_channels=1,
-        output_channels=2,
-        stride=1,
-        kernel_length=2,
-        use_bias=True,
-    ),
-    nk.layer.Lncosh(input_size=8),
-)
+machines["FFFN 1d Hypercube spin FullyConnected"] = partial(ffnn_fully_connected, hi)
 
 # FFNN Machine
-machines["FFFN 1d Hypercube spin Convolutional Hypercube"] = nk.machine.FFNN(hi, layers)
+machines["FFFN 1d Hypercube spin Convolutional Hypercube"] = partial(
+    ffnn_convolutional, hi
+)
 
-machines["MPS Diagonal 1d spin"] = nk.machine.MPSPeriodicDiagonal(hi, bond_dim=3)
-machines["MPS 1d spin"] = nk.machine.MPSPeriodic(hi, bond_dim=3)
+machines["MPS Diagonal 1d spin"] = partial(
+    nk.machine.MPSPeriodicDiagonal, hi, bond_dim=3
+)
+machines["MPS 1d spin"] = partial(nk.machine.MPSPeriodic, hi, bond_dim=3)
 
 # BOSONS
 hi = nk.hilbert.Boson(graph=g, n_max=3)
-machines["RbmSpin 1d Hypercube boson"] = nk.machine.RbmSpin(hilbert=hi, alpha=1)
+machines["RbmSpin 1d Hypercube boson"] = partial(
+    nk.machine.RbmSpin, hilbert=hi, alpha=1
+)
 
-machines["RbmSpinSymm 1d Hypercube boson"] = nk.machine.RbmSpinSymm(hilbert=hi, alpha=2)
-machines["RbmMultiVal 1d Hypercube boson"] = nk.machine.RbmMultiVal(
-    hilbert=hi, n_hidden=10
+machines["RbmSpinSymm 1d Hypercube boson"] = partial(
+    nk.machine.RbmSpinSymm, hilbert=hi, alpha=2
 )
-machines["Jastrow 1d Hypercube boson"] = nk.machine.Jastrow(hilbert=hi)
+machines["RbmMultiVal 1d Hypercube boson"] = partial(
+    nk.machine.RbmMultiVal, hilbert=hi, n_hidden=10
+)
+machines["Jastrow 1d Hypercube boson"] = partial(nk.machine.Jastrow, hilbert=hi)
+
+machines["JastrowSymm 1d Hypercube boson"] = partial(nk.machine.JastrowSymm, hilbert=hi)
+machines["MPS 1d boson"] = partial(nk.machine.MPSPeriodic, hi, bond_dim=4)
+
+all_machines = merge_dicts(machines, dm_machines)
+
+
+def seeded_rng(*keys):
+    # numpy generator seeded from the given keys (test, machine name, ...), so
+    # that every parametrized case draws the same numbers whatever the order
+    # pytest runs the tests in. Unlike hash(), crc32 is stable across
+    # processes. The C++ RandomEngine is only used where the bindings require
+    # it (random_vals)
+    key = " ".join(str(k) for k in keys)
+    return np.random.RandomState(zlib.crc32(key.encode()) & 0xFFFFFFFF)
+
 
-machines["JastrowSymm 1d Hypercube boson"] = nk.machine.JastrowSymm(hilbert=hi)
-machines["MPS 1d boson"] = nk.machine.MPSPeriodic(hi, bond_dim=4)
+def random_complex(rng, n):
+    # Real and imaginary parts drawn in a single fill
+    return rng.randn(2 * n).view(np.complex128)
 
 
-np.random.seed(12346)
+@pytest.fixture(scope="module", params=sorted(all_machines))
+def name(request):
+    return request.param
+
+
+@pytest.fixture(scope="module")
+def machine(name):
+    # Built once per machine, the first time a test in this module uses it
+    return all_machines[name]()
+
+
+@pytest.fixture(scope="module")
+def randpars(name, machine):
+    # Random parameters used by the set/get and save/load tests
+    return random_complex(seeded_rng("randpars", name), machine.n_par)
+
+
+def same_parameters(machine, pars):
+    # Non-holomorphic machines only keep the real part of the parameters
+    got = machine.parameters
+    if machine.is_holomorphic:
+        np.testing.assert_array_equal(got, pars)
+    else:
+        np.testing.assert_array_equal(got.real, pars.real)
+
+
+def wrap_phase(x):
+    # Maps phases to [-pi, pi), so that shifts by multiples of 2 pi vanish
+    return np.mod(x + np.pi, 2.0 * np.pi) - np.pi
 
 
 def same_derivatives(der_log, num_der_log, eps=1.0e-6):
-    assert np.max(np.real(der_log - num_der_log)) == approx(0.0, rel=eps, abs=eps)
+    np.testing.assert_allclose(
+        np.real(der_log), np.real(num_der_log), rtol=eps, atol=eps
+    )
     # The imaginary part is a bit more tricky, there might be an arbitrary phase shift
-    assert np.max(np.exp(np.imag(der_log - num_der_log) * 1.0j) - 1.0) == approx(
-        0.0, rel=eps, abs=eps
+    np.testing.assert_allclose(
+        wrap_phase(np.imag(der_log - num_der_log)), 0.0, atol=eps
     )
 
 
 def log_val_f(par, machine, v):
-    machine.parameters = np.copy(par)
+    machine.parameters = par
     return machine.log_val(v)
 
 
 def central_diff_grad(func, x, eps, *args):
     grad = np.zeros(len(x), dtype=complex)
-    epsd = np.zeros(len(x), dtype=complex)
-    epsd[0] = eps
+    # Perturb one entry at a time in a single buffer, rather than building
+    # fresh shifted copies of x for every parameter
+    xp = np.array(x, dtype=complex)
     for i in range(len(x)):
-        grad[i] = 0.5 * (func(x + epsd, *args) - func(x - epsd, *args)) / eps
-        epsd = np.roll(epsd, 1)
+        xp[i] = x[i] + eps
+        f_plus = func(xp, *args)
+        xp[i] = x[i] - eps
+        f_minus = func(xp, *args)
+        xp[i] = x[i]
+        grad[i] = 0.5 * (f_plus - f_minus) / eps
     return grad
 
 
-def check_holomorphic(func, x, eps, *args):
-    gr = central_diff_grad(func, x, eps, *args)
+def check_holomorphic(gr, func, x, eps, *args):
+    # gr is the central_diff_grad along the real axis, already computed by
+    # the caller: only the derivative along the imaginary axis is needed
     gi = central_diff_grad(func, x, eps * 1.0j, *args)
     same_derivatives(gr, gi)
 
 
-def test_set_get_parameters():
-    for name, machine in merge_dicts(machines, dm_machines).items():
-        print("Machine test: %s" % name)
-        assert machine.n_par > 0
-        npar = machine.n_par
-        randpars = np.random.randn(npar) + 1.0j * np.random.randn(npar)
-        machine.parameters = randpars
-        if machine.is_holomorphic:
-            assert np.array_equal(machine.parameters, randpars)
-        else:
-            assert np.array_equal(machine.parameters.real, randpars.real)
+def random_states(hi, rg, n_states):
+    # random_vals fills a single configuration, so fill in turn the rows of
+    # one preallocated batch. The bindings take Eigen::VectorXd, so C-ordered
+    # float64 rows are passed to C++ without any conversion or copy
+    states = np.zeros((n_states, hi.size), dtype=np.float64)
+    for state in states:
+        hi.random_vals(state, rg)
+    return states
 
 
-def test_save_load_parameters(tmpdir):
-    for name, machine in merge_dicts(machines, dm_machines).items():
-        print("Machine test: %s" % name)
-        assert machine.n_par > 0
-        n_par = machine.n_par
-        randpars = np.random.randn(n_par) + 1.0j * np.random.randn(n_par)
+def test_set_get_parameters(machine, randpars):
+    assert machine.n_par > 0
+    machine.parameters = randpars
+    same_parameters(machine, randpars)
 
-        machine.parameters = np.copy(randpars)
-        fn = tmpdir.mkdir("datawf").join("test.wf")
 
-        filename = os.path.join(fn.dirname, fn.basename)
+@pytest.fixture(scope="module")
+def wf_dir(tmp_path_factory):
+    # A single directory shared by all machines, the file is overwritten
+    return tmp_path_factory.mktemp("datawf")
 
-        machine.save(filename)
-        machine.parameters = np.zeros(n_par, dtype=complex)
-        machine.load(filename)
-        os.remove(filename)
-        os.rmdir(fn.dirname)
-        if machine.is_holomorphic:
-            assert np.array_equal(machine.parameters, randpars)
-        else:
-            assert np.array_equal(machine.parameters.real, randpars.real)
 
+def test_save_load_parameters(machine, randpars, wf_dir):
+    assert machine.n_par > 0
+    n_par = machine.n_par
 
-def test_log_derivative():
-    for name, machine in merge_dicts(machines, dm_machines).items():
-        print("Machine test: %s" % name)
+    machine.parameters = randpars
+    filename = str(wf_dir / "test.wf")
 
-        npar = machine.n_par
+    machine.save(filename)
+    machine.parameters = np.zeros(n_par, dtype=complex)
+    machine.load(filename)
+    same_parameters(machine, randpars)
 
-        # random visibile state
-        hi = machine.hilbert
-        assert hi.size > 0
-        rg = nk.utils.RandomEngine(seed=1234)
-        v = np.zeros(hi.size)
 
-        for i in range(100):
-            hi.random_vals(v, rg)
+@pytest.mark.parametrize("block", range(4))
+def test_log_derivative(name, machine, block):
+    npar = machine.n_par
 
-            randpars = 0.1 * (np.random.randn(npar) + 1.0j * np.random.randn(npar))
-            machine.parameters = randpars
-            der_log = machine.der_log(v)
+    # random visibile states
+    # The samples are independent, so they are split in blocks with their own
+    # seeds, which pytest-xdist can distribute over different workers
+    hi = machine.hilbert
+    assert hi.size > 0
+    rg = nk.utils.RandomEngine(seed=1234 + block)
+    block_rng = seeded_rng("log_derivative", name, block)
+    vs = random_states(hi, rg, 25)
 
-            if "Jastrow" in name:
-                assert np.max(np.imag(der_log)) == approx(0.0)
+    # Jastrow machines have real log-derivatives
+    is_jastrow = "Jastrow" in name
 
-            num_der_log = central_diff_grad(log_val_f, randpars, 1.0e-8, machine, v)
+    for i, v in enumerate(vs):
+        randpars = 0.1 * random_complex(block_rng, npar)
+        machine.parameters = randpars
+        der_log = machine.der_log(v)
 
-            same_derivatives(der_log, num_der_log)
+        if is_jastrow:
+            assert np.max(np.abs(np.imag(der_log))) <= 1.0e-12
 
-            # Check if machine is correctly set to be holomorphic
-            # The check is done only on smaller subset of parameters, for speed
-            if i % 10 == 0 and machine.is_holomorphic:
-                check_holomorphic(log_val_f, randpars, 1.0e-8, machine, v)
+        num_der_log = central_diff_grad(log_val_f, randpars, 1.0e-8, machine, v)
 
+        same_derivatives(der_log, num_der_log)
 
-def test_log_val_diff():
-    for name, machine in merge_dicts(machines, dm_machines).items():
-        print("Machine test: %s" % name)
+        # Check if machine is correctly set to be holomorphic
+        # The check is done only on smaller subset of parameters, for speed
+        if i % 10 == 0 and machine.is_holomorphic:
+            check_holomorphic(num_der_log, log_val_f, randpars, 1.0e-8, machine, v)
 
-        npar = machine.n_par
-        randpars = 0.5 * (np.random.randn(npar) + 1.0j * np.random.randn(npar))
-        machine.parameters = randpars
 
-        hi = machine.hilbert
+def test_log_val_diff(name, machine):
+    npar = machine.n_par
+    rng = seeded_rng("log_val_diff", name)
+    randpars = 0.5 * random_complex(rng, npar)
+    machine.parameters = randpars
 
-        rg = nk.utils.RandomEngine(seed=1234)
+    hi = machine.hilbert
+    n_sites = hi.size
+    local_states = hi.local_states
+    local_states_set = set(local_states)
 
-        # loop over different random states
-        for i in range(100):
+    rg = nk.utils.RandomEngine(seed=1234)
 
-            # generate a random state
-            rstate = np.zeros(hi.size)
-            local_states = hi.local_states
-            hi.random_vals(rstate, rg)
+    # The Hilbert spaces used here are tiny, so the same configurations show
+    # up over and over: compute log_val only once per distinct configuration
+    log_vals = {}
 
-            tochange = []
-            newconfs = []
+    def cached_log_val(state):
+        key = state.tobytes()
+        if key not in log_vals:
+            log_vals[key] = machine.log_val(state)
+        return log_vals[key]
 
-            # random number of changes
-            for i in range(100):
-                n_change = np.random.randint(low=0, high=hi.size)
-                # generate n_change unique sites to be changed
-                tochange.append(np.random.choice(hi.size, n_change, replace=False))
-                newconfs.append(np.random.choice(local_states, n_change))
+    # buffer for the changed states, reused for every move
+    rstatet = np.empty(n_sites, dtype=np.float64)
 
-            ldiffs = machine.log_val_diff(rstate, tochange, newconfs)
-            valzero = machine.log_val(rstate)
+    # loop over different random states
+    for rstate in random_states(hi, rg, 100):
 
-            for toc, newco, ldiff in zip(tochange, newconfs, ldiffs):
-                rstatet = np.array(rstate)
+        # random number of changes, with the random draws done in
+        # fixed-shape blocks and then cut to the length of each move
+        n_changes = rng.randint(low=0, high=n_sites, size=100)
+        newconfs_all = rng.choice(local_states, size=(100, n_sites))
+        # each row is a random permutation of the sites, so its first
+        # n_change entries are n_change unique sites to be changed
+        sites_all = np.argsort(rng.rand(100, n_sites), axis=1)
 
-                for newc in newco:
-                    assert newc in local_states
+        tochange = []
+        newconfs = []
+        for n_change, sites, newc in zip(n_changes, sites_all, newconfs_all):
+            tochange.append(sites[:n_change])
+            newconfs.append(newc[:n_change])
 
-                for t in toc:
-                    assert t >= 0 and t < hi.size
+        ldiffs = machine.log_val_diff(rstate, tochange, newconfs)
+        valzero = cached_log_val(rstate)
 
-                assert len(toc) == len(newco)
+        for toc, newco, ldiff in zip(tochange, newconfs, ldiffs):
+            np.copyto(rstatet, rstate)
 
-                if len(toc) == 0:
-                    assert ldiff == approx(0.0)
+            for newc in newco:
+                assert newc in local_states_set
 
-                hi.update_conf(rstatet, toc, newco)
-                ldiff_num = machine.log_val(rstatet) - valzero
+            for t in toc:
+                assert t >= 0 and t < n_sites
 
-                assert np.max(np.real(ldiff_num - ldiff)) == approx(0.0)
-                # The imaginary part is a bit more tricky, there might be an arbitrary phase shift
-                assert np.max(np.exp(np.imag(ldiff_num - ldiff) * 1.0j)) == approx(1.0)
-                assert np.min(np.exp(np.imag(ldiff_num - ldiff) * 1.0j)) == approx(1.0)
+            assert len(toc) == len(newco)
 
+            if len(toc) == 0:
+                assert abs(ldiff) <= 1.0e-12
 
-def test_nvisible():
-    for name, machine in machines.items():
-        print("Machine test: %s" % name)
-        hi = machine.hilbert
+            hi.update_conf(rstatet, toc, newco)
+            ldiff_num = cached_log_val(rstatet) - valzero
 
-        assert machine.n_visible == hi.size
+            assert abs(np.real(ldiff_num - ldiff)) <= 1.0e-12
+            # The imaginary part is a bit more tricky, there might be an arbitrary phase shift
+            assert abs(wrap_phase(np.imag(ldiff_num - ldiff))) <= 1.0e-6
 
-    for name, machine in dm_machines.items():
-        print("Machine test: %s" % name)
-        hip = machine.hilbert_physical
-        hi = machine.hilbert
 
+def test_nvisible(name, machine):
+    hi = machine.hilbert
+
+    if name in dm_machines:
+        hip = machine.hilbert_physical
         assert machine.n_visible == hip.size
         assert machine.n_visible * 2 == hi.size
+    else:
+        assert machine.n_visible == hi.size